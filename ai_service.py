@@ -1,41 +1,155 @@
+import asyncio
+import random
 import httpx
 import json
+import orjson
+from aiolimiter import AsyncLimiter
+from functools import lru_cache
 from typing import Dict, Any
-from config import settings
-from cultural_knowledge import is_culturally_sensitive_topic, get_kalenjin_phrase
+from config import settings, cfg
+from cultural_knowledge import is_culturally_sensitive_topic
 
 
-async def enrich_prompt_with_culture(base_prompt: str, language: str, user_message: str = "") -> str:
+# Shared client so every SMS reuses pooled keep-alive connections to the AI API
+# (HTTP/2 multiplexes concurrent requests over one TLS connection; proxy env is not consulted)
+# Per-phase timeouts bound tail latency, and retries are off, so a hung request fails fast
+# instead of tying up a worker while the SMS gateway retries
+AI_CLIENT = httpx.AsyncClient(
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=0,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=30.0)
+    ),
+    trust_env=False,
+    timeout=httpx.Timeout(connect=3.0, read=20.0, write=5.0, pool=2.0),
+    headers={
+        "Authorization": f"Bearer {settings.AI_API_KEY}",
+        "Content-Type": "application/json"
+    }
+)
+
+
+# Latest AI model with advanced reasoning first, then fallback
+_MODELS_TO_TRY = ("grok-4.1-fast", "grok-4")
+_unavailable_models: set[str] = set()
+
+# Appended to plain-text AI replies
+_DISCLAIMER_SUFFIX = " " + cfg.SMS_DISCLAIMER_SHORT
+
+# Backpressure on outbound AI calls: cap in-flight requests and overall request rate
+_AI_SEM = asyncio.Semaphore(settings.AI_MAX_CONCURRENCY)
+_AI_LIMITER = AsyncLimiter(settings.AI_REQUESTS_PER_MINUTE, 60)
+_MAX_RATE_LIMIT_RETRIES = 3
+# Upper bound on a single backoff so a large Retry-After can't stall the SMS webhook
+_MAX_RETRY_DELAY = 5.0
+
+# Conversation history sent to the AI: last 3 user/assistant exchanges
+_HISTORY_WINDOW = 6
+_CHAT_ROLES = frozenset({"user", "assistant"})
+
+# Decodes the first JSON object embedded in an AI reply without scanning for its end
+_JSON_DECODER = json.JSONDecoder()
+
+
+# Kalenjin/Bomet cultural guidance appended to prompts for Kalenjin speakers or nutrition queries
+_CULTURAL_ADDITION = (
+    "\n\nCULTURAL CONTEXT (Kalenjin/Bomet traditions): "
+    "You are culturally sensitive to Kalenjin women in Bomet. "
+    "RECOMMENDED: Mwaiti (milk - 63% prefer), managu/sukuma wiki (greens for blood), "
+    "ugali/uji (strength for delivery), liver (iron). "
+    "TRADITIONALLY AVOIDED (>60%): Eggs, meat organs (tongue, heart) - elders say causes big baby/hard labor. "
+    "Avocado, oily foods (20-40% avoid) - fear of complications. "
+    "APPROACH: Respect these traditions, blend with MoH evidence-based advice. "
+    "Explain avoidances without judgment. If language='kal', use Kalenjin/English mix. "
+    "Example: 'Drink mwaiti for strong bones, eat managu for blood.' "
+    "If they avoid eggs, suggest beans and milk for protein. "
+    "Emphasize: Light baby for easy delivery is culturally valued and medically safe."
+)
+
+
+def enrich_prompt_with_culture(base_prompt: str, culturally_sensitive: bool) -> str:
     """
     Enrich system prompt with Kalenjin cultural knowledge.
     
     Args:
         base_prompt: Base system prompt
-        language: Language code ('kal' for Kalenjin)
-        user_message: User's message to check for cultural topics
+        culturally_sensitive: Whether cultural context applies (Kalenjin speaker or cultural topic)
     
     Returns:
         Culturally enriched prompt
     """
-    if language == "kal" or is_culturally_sensitive_topic(user_message):
-        cultural_addition = (
-            "\n\nCULTURAL CONTEXT (Kalenjin/Bomet traditions): "
-            "You are culturally sensitive to Kalenjin women in Bomet. "
-            "RECOMMENDED: Mwaiti (milk - 63% prefer), managu/sukuma wiki (greens for blood), "
-            "ugali/uji (strength for delivery), liver (iron). "
-            "TRADITIONALLY AVOIDED (>60%): Eggs, meat organs (tongue, heart) - elders say causes big baby/hard labor. "
-            "Avocado, oily foods (20-40% avoid) - fear of complications. "
-            "APPROACH: Respect these traditions, blend with MoH evidence-based advice. "
-            "Explain avoidances without judgment. If language='kal', use Kalenjin/English mix. "
-            "Example: 'Drink mwaiti for strong bones, eat managu for blood.' "
-            "If they avoid eggs, suggest beans and milk for protein. "
-            "Emphasize: Light baby for easy delivery is culturally valued and medically safe."
-        )
-        return base_prompt + cultural_addition
+    if culturally_sensitive:
+        return base_prompt + _CULTURAL_ADDITION
     
     return base_prompt
 
 
+@lru_cache(maxsize=4)
+def _build_system_prompt(culturally_sensitive: bool, assessment: bool) -> str:
+    """
+    Build the (cached) system prompt for a topic / output mode combination.
+    
+    The prompt deliberately contains no per-user values, so it forms an identical
+    prefix across requests that the AI provider's prompt cache can reuse.
+    Per-request details go in a trailing message (see _build_messages).
+    
+    Args:
+        culturally_sensitive: Whether cultural context applies (Kalenjin speaker or cultural topic)
+        assessment: If True, build the structured JSON risk assessment prompt
+    
+    Returns:
+        System prompt, enriched with cultural context where relevant
+    """
+    if assessment:
+        system_prompt = (
+            "You are an advanced maternal health risk assessment AI for rural Kenya (Bomet tea region). "
+            "Analyze symptoms, pregnancy context, and cultural factors. "
+            "Output ONLY valid JSON with this structure: "
+            '{"response_text": "helpful SMS advice <250 chars", '
+            '"risk_level": 0.0-1.0 (0=safe, 0.3=monitor, 0.6=concern, 0.8=urgent), '
+            '"reason": "brief clinical reason", '
+            '"recommended_action": "monitor/anc_visit/call_1195/emergency"}'
+        )
+    else:
+        system_prompt = (
+            "You are an advanced reasoning engine for maternal health in rural Kenya, especially Bomet tea farming region. "
+            "Act as superior AI assistant (30% more precise than basic triage) by analyzing: "
+            "symptoms + pregnancy week + cultural context + local risks (malaria in rainy Mulot). "
+            "Use simple words in the user's language. Always refer to clinic/professional. Prioritize referrals to local tea estate clinics or CHWs in Bomet. "
+            "Do NOT diagnose. "
+            "Flag danger signs (bleeding, severe pain, headache/swelling, blurred vision, "
+            "convulsions, fever, reduced fetal movement). Keep responses short for SMS "
+            "(<250 chars). Include disclaimer if needed."
+        )
+    
+    # Enrich prompt with cultural knowledge for Kalenjin speakers or nutrition queries
+    return enrich_prompt_with_culture(system_prompt, culturally_sensitive)
+
+
+def _build_messages(system_prompt: str, history: list, context: str, user_message: str) -> list:
+    """
+    Assemble chat messages with static content first and per-request content last.
+    
+    Args:
+        system_prompt: Static system prompt (shared prefix across requests)
+        history: List of previous conversation messages (trimmed to the recent window)
+        context: Per-request instructions (language, pregnancy week); may be empty
+        user_message: Current user message
+    
+    Returns:
+        Messages list for the chat completion request
+    """
+    # Only chat turns are sent (history also records e.g. "feedback" entries), and only
+    # the most recent ones, to bound upload size and prompt prefill
+    recent = [m for m in history if m.get("role") in _CHAT_ROLES][-_HISTORY_WINDOW:]
+    
+    messages = [{"role": "system", "content": system_prompt}] + recent
+    if context:
+        messages.append({"role": "system", "content": context})
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+
 async def get_ai_response(history: list, user_message: str, language: str = "en", pregnancy_weeks: int = None) -> str:
     """
     Get AI response for maternal health queries.
@@ -49,30 +163,16 @@ async def get_ai_response(history: list, user_message: str, language: str = "en"
     Returns:
         AI-generated response with disclaimer
     """
-    system_prompt = (
-        f"You are an advanced reasoning engine for maternal health in rural Kenya, especially Bomet tea farming region. "
-        f"Act as superior AI assistant (30% more precise than basic triage) by analyzing: "
-        f"symptoms + pregnancy week + cultural context + local risks (malaria in rainy Mulot). "
-        f"Use simple {language}. Always refer to clinic/professional. Prioritize referrals to local tea estate clinics or CHWs in Bomet. "
-        f"Do NOT diagnose. "
-        f"Flag danger signs (bleeding, severe pain, headache/swelling, blurred vision, "
-        f"convulsions, fever, reduced fetal movement). Keep responses short for SMS "
-        f"(<250 chars). Include disclaimer if needed."
-    )
-    
-    # Enrich prompt with cultural knowledge for Kalenjin speakers or nutrition queries
-    system_prompt = await enrich_prompt_with_culture(system_prompt, language, user_message)
+    # Kalenjin speakers always get cultural context, so skip the topic scan for them
+    is_sensitive = language == "kal" or is_culturally_sensitive_topic(user_message)
+    system_prompt = _build_system_prompt(is_sensitive, False)
     
-    # Add pregnancy week context if available
-    context_addition = ""
+    # Language and pregnancy week context go after the cacheable prefix
+    context = f"Reply in simple {language}."
     if pregnancy_weeks:
-        context_addition = f"\n\nCONTEXT: User is at {pregnancy_weeks} weeks pregnant. Adjust advice accordingly."
+        context += f" CONTEXT: User is at {pregnancy_weeks} weeks pregnant. Adjust advice accordingly."
     
-    messages = [
-        {"role": "system", "content": system_prompt + context_addition}
-    ] + history + [
-        {"role": "user", "content": user_message}
-    ]
+    messages = _build_messages(system_prompt, history, context, user_message)
     
     return await _call_ai_api(messages, use_risk_scoring=True)
 
@@ -84,42 +184,23 @@ async def get_ai_risk_assessment(history: list, user_message: str, language: str
     Returns:
         Dict with: response_text, risk_level (0-1), reason, recommended_action
     """
-    system_prompt = (
-        f"You are an advanced maternal health risk assessment AI for rural Kenya (Bomet tea region). "
-        f"Analyze symptoms, pregnancy context, and cultural factors. "
-        f"Output ONLY valid JSON with this structure: "
-        f'{{"response_text": "helpful SMS advice <250 chars", '
-        f'"risk_level": 0.0-1.0 (0=safe, 0.3=monitor, 0.6=concern, 0.8=urgent), '
-        f'"reason": "brief clinical reason", '
-        f'"recommended_action": "monitor/anc_visit/call_1195/emergency"}}'
-    )
-    
-    system_prompt = await enrich_prompt_with_culture(system_prompt, language, user_message)
-    
-    context_addition = ""
+    # Kalenjin speakers always get cultural context, so skip the topic scan for them
+    is_sensitive = language == "kal" or is_culturally_sensitive_topic(user_message)
+    system_prompt = _build_system_prompt(is_sensitive, True)
+    
+    context = ""
     if pregnancy_weeks:
-        context_addition = f"\n\nPregnancy: {pregnancy_weeks} weeks. Consider trimester risks."
+        context = f"Pregnancy: {pregnancy_weeks} weeks. Consider trimester risks."
     
-    messages = [
-        {"role": "system", "content": system_prompt + context_addition}
-    ] + history + [
-        {"role": "user", "content": user_message}
-    ]
+    messages = _build_messages(system_prompt, history, context, user_message)
     
     try:
         response_text = await _call_ai_api(messages, use_risk_scoring=True)
         
-        # Try to parse JSON from response
-        # Handle cases where AI wraps JSON in markdown code blocks
-        if "```json" in response_text:
-            json_start = response_text.find("{")
-            json_end = response_text.rfind("}") + 1
-            json_text = response_text[json_start:json_end]
-        elif "{" in response_text and "}" in response_text:
-            json_start = response_text.find("{")
-            json_end = response_text.rfind("}") + 1
-            json_text = response_text[json_start:json_end]
-        else:
+        # Parse the first JSON object in the response; this also skips any
+        # markdown code fence the AI wraps around it
+        json_start = response_text.find("{")
+        if json_start < 0:
             # Fallback if no JSON found
             return {
                 "response_text": response_text,
@@ -128,7 +209,7 @@ async def get_ai_risk_assessment(history: list, user_message: str, language: str
                 "recommended_action": "monitor"
             }
         
-        risk_data = json.loads(json_text)
+        risk_data, _ = _JSON_DECODER.raw_decode(response_text, json_start)
         
         # Validate structure
         if not all(key in risk_data for key in ["response_text", "risk_level", "recommended_action"]):
@@ -157,48 +238,77 @@ async def _call_ai_api(messages: list, use_risk_scoring: bool = False) -> str:
     Returns:
         API response text
     """
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        # Use latest AI model with advanced reasoning
-        models_to_try = ["grok-4.1-fast", "grok-4"]
+    # Models that already returned 404 in this process are skipped
+    models_to_try = [model for model in _MODELS_TO_TRY if model not in _unavailable_models]
+    
+    payload = {
+        "messages": messages,
+        "temperature": 0.3,
+        "max_tokens": 300 if use_risk_scoring else 200
+    }
+    
+    # Request JSON output for risk scoring
+    if use_risk_scoring:
+        payload["response_format"] = {"type": "json_object"}
+    
+    # Only the model differs between fallback attempts, so encode the rest once
+    # (with orjson) and splice the model field onto the front of the object
+    encoded_payload = orjson.dumps(payload)
+    
+    for model in models_to_try:
+        try:
+            body = b'{"model":' + orjson.dumps(model) + b"," + encoded_payload[1:]
+            resp = await _post_chat_completion(body)
+            resp.raise_for_status()
+            content = orjson.loads(resp.content)["choices"][0]["message"]["content"]
+            
+            # Append disclaimer for non-JSON responses
+            if not use_risk_scoring:
+                return content + _DISCLAIMER_SUFFIX
+            else:
+                return content
+            
+        except httpx.HTTPStatusError as e:
+            # If model not found and we have fallback, remember that and try next model
+            if e.response.status_code == 404 and model != models_to_try[-1]:
+                _unavailable_models.add(model)
+                continue
+            # Otherwise, return error
+            return "Sorry, technical issue. Call your clinic or 1195 now."
+        except Exception as e:
+            # For any other error, return fallback message
+            return "Sorry, technical issue. Call your clinic or 1195 now."
+    
+    return "Sorry, technical issue. Call your clinic or 1195 now."
+
+
+async def _post_chat_completion(body: bytes) -> httpx.Response:
+    """
+    POST a chat completion request, backing off and retrying when rate limited.
+    
+    Args:
+        body: JSON-encoded chat completion request body
+    
+    Returns:
+        Final API response (may still be a 429 once retries are exhausted)
+    """
+    for attempt in range(_MAX_RATE_LIMIT_RETRIES + 1):
+        async with _AI_SEM, _AI_LIMITER:
+            # Content-Type: application/json is already set on the shared client
+            resp = await AI_CLIENT.post(
+                "https://api.x.ai/v1/chat/completions",
+                content=body
+            )
         
-        for model in models_to_try:
-            try:
-                payload = {
-                    "model": model,
-                    "messages": messages,
-                    "temperature": 0.3,
-                    "max_tokens": 300 if use_risk_scoring else 200
-                }
-                
-                # Request JSON output for risk scoring
-                if use_risk_scoring:
-                    payload["response_format"] = {"type": "json_object"}
-                
-                resp = await client.post(
-                    "https://api.x.ai/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {settings.AI_API_KEY}",
-                        "Content-Type": "application/json"
-                    },
-                    json=payload
-                )
-                resp.raise_for_status()
-                content = resp.json()["choices"][0]["message"]["content"]
-                
-                # Append disclaimer for non-JSON responses
-                if not use_risk_scoring:
-                    return content + " " + settings.SMS_DISCLAIMER[:100]
-                else:
-                    return content
-                
-            except httpx.HTTPStatusError as e:
-                # If model not found and we have fallback, try next model
-                if e.response.status_code == 404 and model != models_to_try[-1]:
-                    continue
-                # Otherwise, return error
-                return "Sorry, technical issue. Call your clinic or 1195 now."
-            except Exception as e:
-                # For any other error, return fallback message
-                return "Sorry, technical issue. Call your clinic or 1195 now."
+        if resp.status_code != 429 or attempt == _MAX_RATE_LIMIT_RETRIES:
+            return resp
         
-        return "Sorry, technical issue. Call your clinic or 1195 now."
+        # Honor Retry-After when given in seconds, else back off exponentially; jitter avoids a thundering herd
+        try:
+            delay = float(resp.headers.get("Retry-After", 2 ** attempt))
+        except ValueError:
+            delay = 2 ** attempt
+        delay = min(delay, _MAX_RETRY_DELAY)
+        await asyncio.sleep(delay + random.random())
+    
+    return resp
@@ -3,11 +3,42 @@ CHW referral and tea farm integration module for MamaShield AI.
 Unique feature for Bomet tea farming region.
 """
 import asyncio
-from config import settings
+from types import MappingProxyType
+from config import cfg
 from sms_service import send_sms
 from database import log_metric
 
 
+# Farm-specific pregnancy tips by season and language (read-only)
+_TIPS = MappingProxyType({
+    "picking": MappingProxyType({
+        "en": "During tea picking: Take breaks every hour, stay hydrated (drink mwaiti/water), avoid heavy lifting. Ask supervisor for lighter tasks if tired.",
+        "kal": "Wakati wa kuchuma chai: Rest often, drink mwaiti (milk) na maji, don't carry heavy baskets when pregnant. Tell supervisor if you feel tired."
+    }),
+    "general": MappingProxyType({
+        "en": "Tea farm moms: Wear comfortable shoes, use sun protection, drink plenty of fluids. Report any dizziness to CHW at farm clinic.",
+        "kal": "Mama wa shamba chai: Drink mwaiti, rest when tired, protect from sun. If dizzy, go to clinic haraka (quickly)."
+    })
+})
+
+# Message templates, bound once so only the variable parts are formatted per call
+_CHW_ALERT_TEMPLATE = (
+    "ALERT: High-risk pregnancy reported. "
+    "Masked user {last4} mentioned {signs}. "
+    "Contact urgently. Location area: {location}."
+).format
+
+_FARM_CLINIC_TEMPLATE = (
+    "Referral: Pregnant woman from tea estate needs {reason}. "
+    "Contact {last4} for appointment. MamaShield AI referral."
+).format
+
+_ANC_THANK_YOU = MappingProxyType({
+    "kal": "Kongoi! (Thank you!) Great job attending ANC. Keep it up for healthy pregnancy! Drink mwaiti and rest well.",
+    "en": "Thank you for attending ANC! You're taking great care of yourself and baby. Keep going to all visits!"
+})
+
+
 async def send_chw_alert(phone: str, danger_signs: str, user_location: str = "Mulot tea zone"):
     """
     Send high-risk alert to CHW for urgent follow-up.
@@ -18,21 +49,20 @@ async def send_chw_alert(phone: str, danger_signs: str, user_location: str = "Mu
         user_location: User's location area
     """
     try:
-        chw_message = (
-            f"ALERT: High-risk pregnancy reported. "
-            f"Masked user {phone[-4:]} mentioned {danger_signs}. "
-            f"Contact urgently. Location area: {user_location}."
-        )
+        chw_message = _CHW_ALERT_TEMPLATE(last4=phone[-4:], signs=danger_signs, location=user_location)
         
         # Send to primary CHW
-        await send_sms(settings.CHW_PHONE, chw_message)
+        sends = [send_sms(cfg.CHW_PHONE, chw_message)]
         
         # If tea farm CHW is configured, send there too
-        if hasattr(settings, 'TEA_CHW_PHONE') and settings.TEA_CHW_PHONE:
-            await send_sms(settings.TEA_CHW_PHONE, chw_message)
+        if cfg.TEA_CHW_PHONE:
+            sends.append(send_sms(cfg.TEA_CHW_PHONE, chw_message))
+        
+        # Dispatch alerts concurrently so gateway latency overlaps
+        await asyncio.gather(*sends, return_exceptions=True)
         
         # Log the referral
-        await log_metric("chw_referral", {
+        log_metric("chw_referral", {
             "location": user_location,
             "signs": danger_signs[:50]  # Truncate for privacy
         })
@@ -53,14 +83,11 @@ async def send_farm_clinic_referral(phone: str, reason: str = "ANC checkup"):
         reason: Reason for referral
     """
     try:
-        if hasattr(settings, 'FARM_CLINIC_NUMBER') and settings.FARM_CLINIC_NUMBER:
-            clinic_message = (
-                f"Referral: Pregnant woman from tea estate needs {reason}. "
-                f"Contact {phone[-4:]} for appointment. MamaShield AI referral."
-            )
+        if cfg.FARM_CLINIC_NUMBER:
+            clinic_message = _FARM_CLINIC_TEMPLATE(reason=reason, last4=phone[-4:])
             
-            await send_sms(settings.FARM_CLINIC_NUMBER, clinic_message)
-            await log_metric("farm_clinic_referral", {"reason": reason})
+            await send_sms(cfg.FARM_CLINIC_NUMBER, clinic_message)
+            log_metric("farm_clinic_referral", {"reason": reason})
             
             return True
     except Exception as e:
@@ -78,13 +105,10 @@ async def send_anc_visit_thank_you(phone: str, language: str = "en"):
         language: User's language preference
     """
     try:
-        if language == "kal":
-            message = "Kongoi! (Thank you!) Great job attending ANC. Keep it up for healthy pregnancy! Drink mwaiti and rest well."
-        else:
-            message = "Thank you for attending ANC! You're taking great care of yourself and baby. Keep going to all visits!"
+        message = _ANC_THANK_YOU.get(language, _ANC_THANK_YOU["en"])
         
         await send_sms(phone, message)
-        await log_metric("anc_visit_confirmed", {"language": language})
+        log_metric("anc_visit_confirmed", {"language": language})
         
         return True
         
@@ -104,22 +128,11 @@ def get_farm_specific_tips(season: str = "picking", language: str = "en") -> str
     Returns:
         Farm-specific advice
     """
-    tips = {
-        "picking": {
-            "en": "During tea picking: Take breaks every hour, stay hydrated (drink mwaiti/water), avoid heavy lifting. Ask supervisor for lighter tasks if tired.",
-            "kal": "Wakati wa kuchuma chai: Rest often, drink mwaiti (milk) na maji, don't carry heavy baskets when pregnant. Tell supervisor if you feel tired."
-        },
-        "general": {
-            "en": "Tea farm moms: Wear comfortable shoes, use sun protection, drink plenty of fluids. Report any dizziness to CHW at farm clinic.",
-            "kal": "Mama wa shamba chai: Drink mwaiti, rest when tired, protect from sun. If dizzy, go to clinic haraka (quickly)."
-        }
-    }
-    
-    season_key = season if season in tips else "general"
-    return tips[season_key].get(language, tips[season_key]["en"])
+    season_key = season if season in _TIPS else "general"
+    return _TIPS[season_key].get(language, _TIPS[season_key]["en"])
 
 
-async def track_farm_worker_engagement(phone_hash: str, activity: str):
+def track_farm_worker_engagement(phone_hash: str, activity: str):
     """
     Track tea farm worker engagement for KTDA/Unilever partnership reports.
     
@@ -127,7 +140,7 @@ async def track_farm_worker_engagement(phone_hash: str, activity: str):
         phone_hash: Hashed phone number
         activity: Type of engagement (onboarding, anc_visit, referral, etc.)
     """
-    await log_metric("tea_farm_engagement", {
+    log_metric("tea_farm_engagement", {
         "activity": activity,
         "partnership_tracking": True
     })
@@ -1,3 +1,5 @@
+from dataclasses import dataclass
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -14,6 +16,8 @@ class Settings(BaseSettings):
     CHW_PHONE: str
     TEA_CHW_PHONE: str = ""
     FARM_CLINIC_NUMBER: str = ""
+    AI_MAX_CONCURRENCY: int = 20
+    AI_REQUESTS_PER_MINUTE: int = 300
     
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -21,4 +25,23 @@ class Settings(BaseSettings):
     )
 
 
+@dataclass(slots=True, frozen=True)
+class FrozenSettings:
+    """Process-constant snapshot of the settings read on the per-message hot path."""
+    
+    SMS_DISCLAIMER: str
+    SMS_DISCLAIMER_SHORT: str
+    CHW_PHONE: str
+    TEA_CHW_PHONE: str
+    FARM_CLINIC_NUMBER: str
+
+
 settings = Settings()
+
+cfg = FrozenSettings(
+    SMS_DISCLAIMER=settings.SMS_DISCLAIMER,
+    SMS_DISCLAIMER_SHORT=settings.SMS_DISCLAIMER[:100],
+    CHW_PHONE=settings.CHW_PHONE,
+    TEA_CHW_PHONE=settings.TEA_CHW_PHONE,
+    FARM_CLINIC_NUMBER=settings.FARM_CLINIC_NUMBER
+)
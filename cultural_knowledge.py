@@ -2,6 +2,7 @@
 Cultural knowledge module for Kalenjin/Bomet maternal health practices.
 Based on rural studies and traditional pregnancy beliefs in Bomet, Kenya.
 """
+import re
 
 # Kalenjin pregnancy nutrition - Traditional recommendations
 KALENJIN_RECOMMENDED_FOODS = {
@@ -79,6 +80,18 @@ KALENJIN_PREGNANCY_VALUES = [
     "Community support and sharing"
 ]
 
+# Keywords that mark a message as touching on culturally sensitive topics
+CULTURALLY_SENSITIVE_KEYWORDS = [
+    "food", "eat", "nutrition", "milk", "mwaiti", "egg", "meat",
+    "avocado", "vegetables", "managu", "sukuma", "ugali", "what can i eat",
+    "what should i eat", "avoid", "traditional", "elders", "culture"
+]
+
+_SENSITIVE_RE = re.compile(
+    "|".join(re.escape(keyword) for keyword in CULTURALLY_SENSITIVE_KEYWORDS),
+    re.IGNORECASE
+)
+
 
 def get_cultural_food_advice(food_query: str = None) -> str:
     """
@@ -141,11 +154,4 @@ def is_culturally_sensitive_topic(text: str) -> bool:
     Returns:
         True if culturally sensitive
     """
-    sensitive_keywords = [
-        "food", "eat", "nutrition", "milk", "mwaiti", "egg", "meat",
-        "avocado", "vegetables", "managu", "sukuma", "ugali", "what can i eat",
-        "what should i eat", "avoid", "traditional", "elders", "culture"
-    ]
-    
-    text_lower = text.lower()
-    return any(keyword in text_lower for keyword in sensitive_keywords)
+    return _SENSITIVE_RE.search(text) is not None
@@ -1,44 +1,51 @@
-from config import settings
+import re
+
+from config import cfg
+
+
+EN_DANGER_KEYWORDS = [
+    "bleeding", "severe pain", "headache", "swelling",
+    "blurred vision", "convulsions", "fever", "reduced fetal movement"
+]
+
+SW_DANGER_KEYWORDS = [
+    "damu", "maumivu makali", "kichwa", "uvimbe",
+    "kuona giza", "mshtuko", "homa", "mtoto ashangaa"
+]
+
+# Kalenjin danger sign keywords
+KAL_DANGER_KEYWORDS = [
+    "bleeding", "damu", "pain makali", "kichwa kuuma",
+    "swelling", "vision", "convulsions", "homa", "baby not moving"
+]
+
+_DANGER_WARNING = f"Danger sign detected! Go to clinic NOW or call 1195. {cfg.SMS_DISCLAIMER}"
+
+# One compiled alternation per language, so each SMS is scanned in a single pass
+_PATTERNS = {
+    lang: re.compile("|".join(re.escape(kw) for kw in keywords), re.IGNORECASE)
+    for lang, keywords in (
+        ("en", EN_DANGER_KEYWORDS),
+        ("sw", SW_DANGER_KEYWORDS),
+        ("kal", KAL_DANGER_KEYWORDS),
+    )
+}
 
 
 def detect_danger_signs(text: str, language: str = "en") -> tuple[bool, str]:
     """
     Detect maternal health danger signs in user messages.
-    
+
     Args:
         text: User message to analyze
         language: Language code ("en", "sw", or "kal")
-    
+
     Returns:
         Tuple of (is_danger_detected, warning_message)
     """
-    en_keywords = [
-        "bleeding", "severe pain", "headache", "swelling", 
-        "blurred vision", "convulsions", "fever", "reduced fetal movement"
-    ]
-    
-    sw_keywords = [
-        "damu", "maumivu makali", "kichwa", "uvimbe", 
-        "kuona giza", "mshtuko", "homa", "mtoto ashangaa"
-    ]
-    
-    # Kalenjin danger sign keywords
-    kal_keywords = [
-        "bleeding", "damu", "pain makali", "kichwa kuuma",
-        "swelling", "vision", "convulsions", "homa", "baby not moving"
-    ]
-    
-    if language == "kal":
-        keywords = kal_keywords
-    elif language == "sw":
-        keywords = sw_keywords
-    else:
-        keywords = en_keywords
-    
-    text_lower = text.lower()
-    
-    for kw in keywords:
-        if kw in text_lower:
-            return True, f"Danger sign detected! Go to clinic NOW or call 1195. {settings.SMS_DISCLAIMER}"
-    
+    pattern = _PATTERNS.get(language, _PATTERNS["en"])
+
+    if pattern.search(text):
+        return True, _DANGER_WARNING
+
     return False, None
@@ -1,6 +1,12 @@
+import asyncio
 import hashlib
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Date, DateTime, JSON
+from functools import lru_cache
+import orjson
+from cachetools import TTLCache
+from sqlalchemy import Column, Integer, String, Date, DateTime, JSON, cast, func, insert, literal, update
+from sqlalchemy.dialects.postgresql import JSONB, JSONPATH, insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy.future import select
@@ -37,8 +43,17 @@ class Metrics(Base):
     details = Column(JSON, default=dict)  # e.g., {'language': 'kal'}
 
 
-# Create async engine
-engine = create_async_engine(settings.DATABASE_URL, echo=False)
+# Create async engine; JSON columns (de)serialize with orjson instead of stdlib json
+engine = create_async_engine(
+    settings.DATABASE_URL,
+    echo=False,
+    json_serializer=lambda obj: orjson.dumps(obj).decode(),
+    json_deserializer=orjson.loads
+)
+_IS_POSTGRES = engine.dialect.name == "postgresql"
+
+# Dialect-specific INSERT supporting ON CONFLICT ... RETURNING, if the backend has one
+_upsert_insert = {"postgresql": postgresql_insert, "sqlite": sqlite_insert}.get(engine.dialect.name)
 
 # Create async session maker
 AsyncSessionLocal = sessionmaker(
@@ -47,6 +62,17 @@ AsyncSessionLocal = sessionmaker(
     expire_on_commit=False
 )
 
+# Metrics are queued by log_metric and written in batches off the request path
+metric_queue: asyncio.Queue = asyncio.Queue(maxsize=10_000)
+_METRIC_BATCH_SIZE = 100
+
+# phone_hash -> User.id, so repeat lookups hit the primary key instead of the WHERE
+_user_pk_cache = TTLCache(maxsize=10_000, ttl=600)
+
+# phone_hash -> detached User, so repeat texters within a minute skip the DB entirely.
+# Writes below keep entries current; other worker processes may lag by up to the TTL.
+_user_cache = TTLCache(maxsize=10_000, ttl=60)
+
 
 async def init_db():
     """Initialize database tables."""
@@ -54,16 +80,60 @@ async def init_db():
         await conn.run_sync(Base.metadata.create_all)
 
 
-async def get_or_create_user(phone: str):
-    """Get existing user or create new one based on phone number."""
-    phone_hash = hashlib.sha256(phone.encode()).hexdigest()
+async def _get_user_by_hash(session: AsyncSession, phone_hash: str):
+    """Load user by phone hash, using the cached primary key when available."""
+    pk = _user_pk_cache.get(phone_hash)
+    if pk is not None:
+        user = await session.get(User, pk)
+        if user:
+            return user
+    
+    result = await session.execute(
+        select(User).where(User.phone_hash == phone_hash)
+    )
+    user = result.scalar_one_or_none()
+    
+    if user:
+        _user_pk_cache[phone_hash] = user.id
+    
+    return user
+
+
+@lru_cache(maxsize=100_000)
+def hash_phone(phone: str) -> str:
+    """Hash a phone number into its stored identifier (memoized; the mapping is stable)."""
+    return hashlib.sha256(phone.encode()).hexdigest()
+
+
+async def get_or_create_user(phone: str, phone_hash: str = None):
+    """Get existing user or create new one based on phone number (or its precomputed hash)."""
+    phone_hash = phone_hash or hash_phone(phone)
+    
+    user = _user_cache.get(phone_hash)
+    if user is not None:
+        return user
     
     async with AsyncSessionLocal() as session:
+        if _upsert_insert is not None:
+            # Single round-trip: insert a new user or touch the existing one, returning the row
+            now = datetime.utcnow()
+            stmt = (
+                _upsert_insert(User)
+                .values(phone_hash=phone_hash, last_interaction=now, history=[])
+                .on_conflict_do_update(
+                    index_elements=[User.phone_hash],
+                    set_={"last_interaction": now}
+                )
+                .returning(User)
+            )
+            user = (await session.scalars(stmt)).one()
+            await session.commit()
+            _user_pk_cache[phone_hash] = user.id
+            _user_cache[phone_hash] = user
+            return user
+        
         # Query by phone_hash
-        result = await session.execute(
-            select(User).where(User.phone_hash == phone_hash)
-        )
-        user = result.scalar_one_or_none()
+        user = await _get_user_by_hash(session, phone_hash)
         
         if not user:
             user = User(
@@ -74,43 +144,154 @@ async def get_or_create_user(phone: str):
             session.add(user)
             await session.commit()
             await session.refresh(user)
+            _user_pk_cache[phone_hash] = user.id
         
+        _user_cache[phone_hash] = user
         return user
 
 
 async def update_user(phone_hash: str, **kwargs):
     """Update user fields."""
     async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(User).where(User.phone_hash == phone_hash)
-        )
-        user = result.scalar_one_or_none()
+        user = await _get_user_by_hash(session, phone_hash)
         
         if user:
             for k, v in kwargs.items():
                 setattr(user, k, v)
             await session.commit()
+            _user_cache[phone_hash] = user
 
 
-async def append_history(phone_hash: str, role: str, content: str):
-    """Append message to user's conversation history."""
+async def increment_interaction_count(phone_hash: str) -> int:
+    """
+    Atomically increment a user's interaction count.
+    
+    The increment runs in the UPDATE itself, so concurrent workers never lose
+    a count to a stale cached value.
+    
+    Returns:
+        The new interaction count (0 if the user doesn't exist)
+    """
     async with AsyncSessionLocal() as session:
         result = await session.execute(
-            select(User).where(User.phone_hash == phone_hash)
+            update(User)
+            .where(User.phone_hash == phone_hash)
+            .values(interaction_count=func.coalesce(User.interaction_count, 0) + 1)
+            .returning(User.interaction_count)
         )
-        user = result.scalar_one_or_none()
+        interaction_count = result.scalar_one_or_none() or 0
+        await session.commit()
+    
+    cached = _user_cache.get(phone_hash)
+    if cached is not None:
+        cached.interaction_count = interaction_count
+    return interaction_count
+
+
+async def append_history(phone_hash: str, role: str, content: str):
+    """Append message to user's conversation history."""
+    await append_history_bulk(phone_hash, [(role, content)])
+
+
+async def append_history_bulk(phone_hash: str, rows: list[tuple[str, str]], **kwargs):
+    """
+    Append several messages to user's conversation history in one round-trip.
+    
+    Args:
+        phone_hash: Hashed phone number
+        rows: (role, content) pairs to append, oldest first
+        **kwargs: Other user fields to update in the same statement/transaction
+    """
+    entries = [{"role": role, "content": content} for role, content in rows]
+    
+    if _IS_POSTGRES:
+        # Append and trim server-side in one UPDATE; only the new messages are shipped
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as session:
+            history = func.coalesce(cast(User.history, JSONB), literal([], JSONB))
+            appended = history.op("||")(literal(entries, JSONB))
+            await session.execute(
+                update(User)
+                .where(User.phone_hash == phone_hash)
+                .values(
+                    history=cast(func.jsonb_path_query_array(appended, literal("$[last - 9 to last]", JSONPATH)), JSON),  # Keep last 10 messages
+                    last_interaction=now,
+                    **kwargs
+                )
+            )
+            await session.commit()
+        
+        # Mirror the same change onto the cached user
+        cached = _user_cache.get(phone_hash)
+        if cached is not None:
+            cached.history = ((cached.history or []) + entries)[-10:]
+            cached.last_interaction = now
+            for k, v in kwargs.items():
+                setattr(cached, k, v)
+        return
+    
+    async with AsyncSessionLocal() as session:
+        user = await _get_user_by_hash(session, phone_hash)
         
         if user:
-            history = user.history or []
-            history.append({"role": role, "content": content})
-            user.history = history[-10:]  # Keep last 10 messages
+            # Build a new list: mutating the loaded one in place hides the change from SQLAlchemy
+            user.history = ((user.history or []) + entries)[-10:]  # Keep last 10 messages
             user.last_interaction = datetime.utcnow()
+            for k, v in kwargs.items():
+                setattr(user, k, v)
             await session.commit()
+            _user_cache[phone_hash] = user
 
 
-async def log_metric(event_type: str, details: dict = {}):
-    """Log anonymized metrics for impact tracking."""
-    async with AsyncSessionLocal() as session:
-        metric = Metrics(event_type=event_type, details=details)
-        session.add(metric)
-        await session.commit()
+def log_metric(event_type: str, details: dict = {}):
+    """Queue anonymized metric for impact tracking (written in batches by drain_metrics)."""
+    try:
+        metric_queue.put_nowait((event_type, details, datetime.utcnow()))
+    except asyncio.QueueFull:
+        print(f"Metrics queue full, dropping {event_type}")
+
+
+async def _write_metrics(batch: list):
+    """Insert a batch of queued metrics in a single statement."""
+    try:
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                insert(Metrics),
+                [
+                    {"event_type": event_type, "details": details, "timestamp": timestamp}
+                    for event_type, details, timestamp in batch
+                ]
+            )
+            await session.commit()
+    except Exception as e:
+        print(f"Metrics write error: {e}")
+
+
+async def drain_metrics():
+    """Background task: write queued metrics to the database in batches until stop_metrics() is called."""
+    while True:
+        batch = [await metric_queue.get()]
+        while len(batch) < _METRIC_BATCH_SIZE and not metric_queue.empty():
+            batch.append(metric_queue.get_nowait())
+        # None is the stop signal; finish writing the batch it arrived with before exiting
+        stopping = None in batch
+        batch = [m for m in batch if m is not None]
+        if batch:
+            await _write_metrics(batch)
+        if stopping:
+            return
+
+
+async def stop_metrics(task: asyncio.Task):
+    """Signal drain_metrics to stop and wait for its in-flight batch to be written."""
+    await metric_queue.put(None)
+    await task
+
+
+async def flush_metrics():
+    """Write any metrics still queued (used on shutdown)."""
+    while not metric_queue.empty():
+        batch = []
+        while len(batch) < _METRIC_BATCH_SIZE and not metric_queue.empty():
+            batch.append(metric_queue.get_nowait())
+        await _write_metrics(batch)
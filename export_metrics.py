@@ -3,7 +3,8 @@ Export metrics to CSV for pitch presentations.
 Run with: python export_metrics.py
 """
 import asyncio
-import pandas as pd
+import csv
+from collections import Counter
 from sqlalchemy.future import select
 
 from database import AsyncSessionLocal, Metrics
@@ -11,30 +12,29 @@ from database import AsyncSessionLocal, Metrics
 
 async def export_metrics():
     """Export all metrics from database to CSV file."""
+    event_counts = Counter()
+
     async with AsyncSessionLocal() as session:
-        result = await session.execute(select(Metrics))
-        metrics = result.scalars().all()
-        
-        # Convert to list of dicts
-        data = []
-        for m in metrics:
-            data.append({
-                'id': m.id,
-                'timestamp': m.timestamp,
-                'event_type': m.event_type,
-                'count': m.count,
-                'details': str(m.details)
-            })
-        
-        # Create DataFrame and export
-        df = pd.DataFrame(data)
-        df.to_csv('metrics_export.csv', index=False)
-        
-        print(f"✅ Exported {len(data)} metrics to metrics_export.csv")
-        
-        # Print summary stats
-        print("\n📊 Metrics Summary:")
-        print(df['event_type'].value_counts())
+        # Stream rows in batches instead of loading the whole table into memory
+        result = await session.stream(
+            select(Metrics).execution_options(yield_per=1000)
+        )
+
+        with open('metrics_export.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['id', 'timestamp', 'event_type', 'count', 'details'])
+
+            async for partition in result.scalars().partitions():
+                for m in partition:
+                    writer.writerow([m.id, m.timestamp, m.event_type, m.count, str(m.details)])
+                    event_counts[m.event_type] += 1
+
+    print(f"✅ Exported {sum(event_counts.values())} metrics to metrics_export.csv")
+
+    # Print summary stats
+    print("\n📊 Metrics Summary:")
+    for event_type, count in event_counts.most_common():
+        print(f"{event_type}: {count}")
 
 
 if __name__ == "__main__":
@@ -1,18 +1,18 @@
-from fastapi import FastAPI, Request
+import asyncio
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
+from slowapi import _rate_limit_exceeded_handler
 
-from config import settings
-from database import init_db
-from routes import router
+from database import init_db, drain_metrics, stop_metrics, flush_metrics
+from ai_service import AI_CLIENT
+from rate_limit import limiter
+from routes import router, wait_for_background_tasks
 
 
 # Initialize FastAPI app
 app = FastAPI(title="MamaShield AI", version="0.1")
 
 # Setup rate limiter
-limiter = Limiter(key_func=get_remote_address)
 app.state.limiter = limiter
 app.add_exception_handler(429, _rate_limit_exceeded_handler)
 
@@ -27,8 +27,19 @@ app.add_middleware(
 
 @app.on_event("startup")
 async def startup():
-    """Initialize database on application startup."""
+    """Initialize database and start the metrics writer on application startup."""
     await init_db()
+    app.state.metrics_task = asyncio.create_task(drain_metrics())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Flush queued metrics and close pooled AI API connections on application shutdown."""
+    # Let in-flight reply SMS finish (they log metrics) before flushing
+    await wait_for_background_tasks()
+    await stop_metrics(app.state.metrics_task)
+    await flush_metrics()
+    await AI_CLIENT.aclose()
 
 
 @app.get("/")
@@ -0,0 +1,14 @@
+"""
+Shared rate limiter for MamaShield AI.
+The same instance is registered on the app and used by route decorators.
+"""
+from slowapi import Limiter
+from slowapi.util import get_remote_address
+
+
+# Moving window avoids the 2x burst a fixed window allows at window boundaries
+limiter = Limiter(
+    key_func=get_remote_address,
+    storage_uri="memory://",
+    strategy="moving-window"
+)
@@ -1,19 +1,46 @@
+import asyncio
+import re
 from fastapi import APIRouter, Form, Request
-from slowapi import Limiter
-from slowapi.util import get_remote_address
-from datetime import datetime
-import dateparser
-
-from config import settings
-from database import get_or_create_user, append_history, log_metric, update_user
-from ai_service import get_ai_response, get_ai_risk_assessment
+from datetime import date
+
+from database import hash_phone, get_or_create_user, append_history, append_history_bulk, increment_interaction_count, log_metric, update_user
+from ai_service import get_ai_risk_assessment
 from sms_service import send_sms
 from danger_detection import detect_danger_signs
+from rate_limit import limiter
 from chw_referral import send_chw_alert, send_anc_visit_thank_you, get_farm_specific_tips, track_farm_worker_engagement
 
 
 router = APIRouter()
-limiter = Limiter(key_func=get_remote_address)
+
+# Reply tokens for polls, as O(1) set lookups
+_FEEDBACK_TOKENS = frozenset({"HELPFUL", "NOT HELPFUL"})
+_POSITIVE_FEEDBACK_WORDS = frozenset({"YES", "Y", "HELPFUL", "GOOD"})
+_WORD_RE = re.compile(r"[A-Z]+")
+_ANC_TOKENS = frozenset({"Y", "YES", "N", "NO"})
+_ANC_YES_TOKENS = frozenset({"Y", "YES"})
+
+# Strong references to in-flight background tasks so they aren't garbage-collected mid-flight
+_BG_TASKS: set[asyncio.Task] = set()
+
+
+def _run_in_background(coro) -> None:
+    """Schedule work that the gateway doesn't need to wait for."""
+    task = asyncio.create_task(coro)
+    _BG_TASKS.add(task)
+    task.add_done_callback(_BG_TASKS.discard)
+
+
+async def wait_for_background_tasks() -> None:
+    """Wait for scheduled background work (e.g. reply SMS) to finish; used on shutdown."""
+    await asyncio.gather(*_BG_TASKS, return_exceptions=True)
+
+
+async def _deliver_response(phone: str, message: str, details: dict = {}):
+    """Send the reply SMS and record that it was sent."""
+    sms_result = await send_sms(phone, message)
+    if sms_result:
+        log_metric("message_sent", details)
 
 
 async def process_message(phone: str, text: str) -> str:
@@ -21,83 +48,97 @@ async def process_message(phone: str, text: str) -> str:
     Process incoming message (shared logic for SMS and USSD).
     Returns the AI response.
     """
-    # Get or create user
-    user = await get_or_create_user(phone)
+    # Normalize the message once for the control-token checks below
+    text_stripped = text.strip()
+    text_upper = text_stripped.upper()
+    
+    # Hash once and thread it through every DB call below
+    phone_hash = hash_phone(phone)
+    
+    # Get or create user (every branch below reads or writes the user row)
+    user = await get_or_create_user(phone, phone_hash)
     language = user.language or "en"
     
     # Check if user is identifying as tea farm worker
-    text_upper = text.strip().upper()
     if text_upper == "TEA":
-        await update_user(user.phone_hash, is_tea_farm_worker=1, language="kal")
-        await track_farm_worker_engagement(user.phone_hash, "onboarding")
+        await update_user(phone_hash, is_tea_farm_worker=1, language="kal")
+        track_farm_worker_engagement(phone_hash, "onboarding")
         farm_tips = get_farm_specific_tips("picking", "kal")
         response = f"Welcome tea farm mama! {farm_tips} We'll send you special tips for farm workers."
-        await log_metric("tea_farm_registration")
+        log_metric("tea_farm_registration")
         return response
     
     # Check for feedback responses
-    if text_upper in ['HELPFUL', 'NOT HELPFUL'] or (len(text_upper) <= 20 and ('HELP' in text_upper or 'YES' in text_upper or 'NO' in text_upper)):
-        feedback_value = "positive" if any(word in text_upper for word in ['YES', 'Y', 'HELPFUL', 'GOOD']) else "negative"
-        await log_metric("feedback_received", {"sentiment": feedback_value, "language": language})
-        await append_history(user.phone_hash, "feedback", feedback_value)
+    if text_upper in _FEEDBACK_TOKENS or (len(text_upper) <= 20 and ('HELP' in text_upper or 'YES' in text_upper or 'NO' in text_upper)):
+        # Compare whole words (ignoring punctuation); NOT negates, while a bare NO
+        # only counts as negative when no positive word is present ("Yes, no problem")
+        words = frozenset(_WORD_RE.findall(text_upper))
+        is_positive = "NOT" not in words and not words.isdisjoint(_POSITIVE_FEEDBACK_WORDS)
+        feedback_value = "positive" if is_positive else "negative"
+        log_metric("feedback_received", {"sentiment": feedback_value, "language": language})
+        await append_history(phone_hash, "feedback", feedback_value)
         return "Thank you for your feedback! It helps us improve MamaShield for all mamas."
     
     # Check if this is an ANC poll response
-    if text_upper in ['Y', 'YES', 'N', 'NO']:
-        if text_upper in ['Y', 'YES']:
-            await log_metric("anc_poll_yes", {"language": language})
+    if text_upper in _ANC_TOKENS:
+        if text_upper in _ANC_YES_TOKENS:
+            log_metric("anc_poll_yes", {"language": language})
             
             # Send thank you for ANC visit (referral incentive)
             await send_anc_visit_thank_you(phone, language)
             
             # Track for tea farm workers (KTDA partnership data)
             if user.is_tea_farm_worker:
-                await track_farm_worker_engagement(user.phone_hash, "anc_visit")
+                track_farm_worker_engagement(phone_hash, "anc_visit")
             
             return "Great! Keep attending your ANC visits. Your health matters!"
         else:
-            await log_metric("anc_poll_no", {"language": language})
+            log_metric("anc_poll_no", {"language": language})
             return "Please visit your clinic soon for ANC checkup. It's important for you and baby."
     
     # Check for danger signs first
     is_danger, danger_msg = detect_danger_signs(text, language)
     if is_danger:
-        await log_metric("danger_flag", {"language": language})
+        log_metric("danger_flag", {"language": language})
         
-        # Send enhanced CHW alert with location context
+        # Send enhanced CHW alert with location context; the alert and history
+        # write are independent, so run them concurrently
         location = "Mulot tea zone" if user.is_tea_farm_worker else "Bomet area"
-        await send_chw_alert(phone, text[:100], location)
-        
-        await append_history(user.phone_hash, "user", text)
-        await append_history(user.phone_hash, "assistant", danger_msg)
+        await asyncio.gather(
+            send_chw_alert(phone, text_stripped[:100], location),
+            append_history_bulk(phone_hash, [("user", text), ("assistant", danger_msg)])
+        )
         return danger_msg
     
     # Get conversation history
     history = user.history or []
     pregnancy_weeks = user.pregnancy_weeks
     
-    # Use advanced AI risk assessment for better precision
-    risk_assessment = await get_grok_risk_assessment(history, text, language, pregnancy_weeks)
+    # Use advanced AI risk assessment for better precision; the interaction count is
+    # incremented in the database meanwhile, and the polls below use the returned value
+    risk_assessment, interaction_count = await asyncio.gather(
+        get_ai_risk_assessment(history, text, language, pregnancy_weeks),
+        increment_interaction_count(phone_hash)
+    )
     
     ai_response = risk_assessment.get("response_text", "Please visit your clinic for checkup.")
     risk_level = risk_assessment.get("risk_level", 0.3)
     recommended_action = risk_assessment.get("recommended_action", "monitor")
     
+    # Independent side effects, awaited together with the history write at the end
+    side_effects = []
+    
     # Auto-trigger CHW alert for high-risk cases (>0.6)
     if risk_level > 0.6:
-        await log_metric("high_risk_detected", {"risk_level": risk_level, "action": recommended_action})
+        log_metric("high_risk_detected", {"risk_level": risk_level, "action": recommended_action})
         location = "Mulot tea zone" if user.is_tea_farm_worker else "Bomet area"
         risk_reason = risk_assessment.get("reason", "High risk detected by AI")
-        await send_chw_alert(phone, f"{text[:50]} - Risk: {risk_reason}", location)
+        side_effects.append(send_chw_alert(phone, f"{text_stripped[:50]} - Risk: {risk_reason}", location))
         
         # Add urgent notice to response
         if recommended_action == "emergency" or risk_level > 0.8:
             ai_response = f"URGENT: {ai_response} Call 1195 or go to clinic NOW."
     
-    # Increment interaction count
-    interaction_count = (user.interaction_count or 0) + 1
-    await update_user(user.phone_hash, interaction_count=interaction_count)
-    
     # First interaction - ask about tea farm work
     if interaction_count == 1:
         ai_response += " Reply TEA if you work/pick tea - get special tips for farm moms."
@@ -106,7 +147,7 @@ async def process_message(phone: str, text: str) -> str:
     if interaction_count % 5 == 0:
         feedback_poll = "Was our advice helpful? Reply YES or NO."
         ai_response += f" {feedback_poll}"
-        await log_metric("feedback_poll_sent")
+        log_metric("feedback_poll_sent")
     
     # Send ANC poll every 4 interactions
     elif interaction_count % 4 == 0:
@@ -118,9 +159,11 @@ async def process_message(phone: str, text: str) -> str:
         farm_tip = get_farm_specific_tips("picking", language)
         ai_response += f" Farm tip: {farm_tip[:80]}..."
     
-    # Update conversation history
-    await append_history(user.phone_hash, "user", text)
-    await append_history(user.phone_hash, "assistant", ai_response)
+    # Update conversation history alongside the side effects
+    await asyncio.gather(
+        append_history_bulk(phone_hash, [("user", text), ("assistant", ai_response)]),
+        *side_effects
+    )
     
     return ai_response
 
@@ -141,15 +184,13 @@ async def receive_sms(
     """
     try:
         # Log incoming message
-        await log_metric("message_received")
+        log_metric("message_received")
         
         # Process message
         ai_response = await process_message(phone, text)
         
-        # Send SMS response
-        sms_result = await send_sms(phone, ai_response)
-        if sms_result:
-            await log_metric("message_sent")
+        # Send SMS response after acknowledging the webhook
+        _run_in_background(_deliver_response(phone, ai_response))
         
         return {"status": "success", "response": ai_response}
         
@@ -190,27 +231,35 @@ async def ussd_callback(
             # Try to parse as date or weeks
             user = await get_or_create_user(phoneNumber)
             
-            # Try parsing as date first
-            parsed_date = dateparser.parse(user_input)
+            # Fast paths first: ISO date (YYYY-MM-DD), then weeks; dateparser only for free-form dates
+            parsed_date = None
+            weeks = None
+            try:
+                parsed_date = date.fromisoformat(user_input.strip())
+            except ValueError:
+                try:
+                    weeks = int(user_input)
+                except ValueError:
+                    import dateparser  # heavy import, deferred until actually needed
+                    parsed = dateparser.parse(user_input)
+                    parsed_date = parsed.date() if parsed else None
+            
             if parsed_date:
-                await update_user(user.phone_hash, pregnancy_due_date=parsed_date.date())
+                await update_user(user.phone_hash, pregnancy_due_date=parsed_date)
                 response = "END Registered! Your due date is saved. Check SMS for tips."
-                await log_metric("registration", {"via": "ussd"})
+                log_metric("registration", {"via": "ussd"})
+            elif weeks is not None:
+                await update_user(user.phone_hash, pregnancy_weeks=weeks)
+                response = f"END Registered! You're at week {weeks}. Check SMS for tips."
+                log_metric("registration", {"via": "ussd"})
             else:
-                # Try parsing as weeks
-                try:
-                    weeks = int(user_input)
-                    await update_user(user.phone_hash, pregnancy_weeks=weeks)
-                    response = "END Registered! You're at week {weeks}. Check SMS for tips."
-                    await log_metric("registration", {"via": "ussd"})
-                except:
-                    response = "END Invalid input. Please try again via SMS."
+                response = "END Invalid input. Please try again via SMS."
         
         # User selected option 2 - Get tip
         elif text == "2":
             tip = "Eat healthy, rest well, attend ANC. Check SMS for personalized advice!"
             response = f"END {tip}"
-            await log_metric("ussd_tip_request")
+            log_metric("ussd_tip_request")
         
         # User selected option 3 - Ask question
         elif text == "3":
@@ -219,14 +268,13 @@ async def ussd_callback(
         # User is asking a question after selecting 3
         elif text.startswith("3*"):
             question = text.split("*", 1)[1]
-            await log_metric("message_received", {"via": "ussd"})
+            log_metric("message_received", {"via": "ussd"})
             
             # Process the question
             ai_response = await process_message(phoneNumber, question)
             
-            # Send full response via SMS
-            await send_sms(phoneNumber, ai_response)
-            await log_metric("message_sent", {"via": "ussd"})
+            # Send full response via SMS after ending the USSD session
+            _run_in_background(_deliver_response(phoneNumber, ai_response, {"via": "ussd"}))
             
             response = "END Thank you! Check SMS for detailed answer."
         